@@ -1,28 +1,43 @@
-from enum import Enum
+from enum import Enum, IntEnum
 import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import credentials, firestore_async
 from fastapi import Request, HTTPException, Depends
 from functools import wraps
+from dataclasses import dataclass, field
+import inspect
+import asyncio
 import os
 from typing import List, Optional, Dict
+from cachetools import TTLCache
 import redis.asyncio as redis
-import json
+import orjson
 import secrets
+import hashlib
 import time
 
-# Initialize Firebase Admin with environment variables
-cred = credentials.Certificate({
-    "type": "service_account",
-    "project_id": os.environ.get("FIREBASE_PROJECT_ID"),
-    "private_key": os.environ.get("FIREBASE_PRIVATE_KEY", "").replace("\\n", "\n"),
-    "client_email": os.environ.get("FIREBASE_CLIENT_EMAIL"),
-    "token_uri": "https://oauth2.googleapis.com/token",
-    "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-    "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-    "client_x509_cert_url": f"https://www.googleapis.com/robot/v1/metadata/x509/{os.environ.get('FIREBASE_CLIENT_EMAIL', '').replace('@', '%40')}"
-})
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+_db = None
+
+def get_db():
+    """Get the shared Firestore client, initializing Firebase Admin on first use."""
+    global _db
+    if _db is None:
+        try:
+            firebase_admin.get_app()
+        except ValueError:
+            # Initialize Firebase Admin with environment variables
+            cred = credentials.Certificate({
+                "type": "service_account",
+                "project_id": os.environ.get("FIREBASE_PROJECT_ID"),
+                "private_key": os.environ.get("FIREBASE_PRIVATE_KEY", "").replace("\\n", "\n"),
+                "client_email": os.environ.get("FIREBASE_CLIENT_EMAIL"),
+                "token_uri": "https://oauth2.googleapis.com/token",
+                "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+                "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
+                "client_x509_cert_url": f"https://www.googleapis.com/robot/v1/metadata/x509/{os.environ.get('FIREBASE_CLIENT_EMAIL', '').replace('@', '%40')}"
+            })
+            firebase_admin.initialize_app(cred)
+        _db = firestore_async.client()
+    return _db
 
 # Initialize Redis with environment variables
 redis_url = os.environ.get("REDIS_URL")
@@ -30,15 +45,19 @@ if not redis_url:
     raise ValueError("REDIS_URL environment variable is not set")
 
 try:
-    redis_client = redis.from_url(
+    # One explicit pool shared by auth and rate limiting, closed in main's lifespan.
+    # Blocking so a burst past max_connections waits for a free socket instead of failing
+    redis_pool = redis.BlockingConnectionPool.from_url(
         redis_url,
         encoding="utf-8",
         decode_responses=True,
         socket_connect_timeout=5,  # Reduce timeout
-        socket_keepalive=True      # Keep connection alive
+        socket_keepalive=True,     # Keep connection alive
+        max_connections=64,        # Shared by auth and rate limiting
+        timeout=5,                 # Longest wait for a free connection
+        health_check_interval=30   # Recycle dead idle connections before use
     )
-    # Test the connection
-    redis_client.ping()
+    redis_client = redis.Redis(connection_pool=redis_pool)
 except Exception as e:
     print(f"Failed to initialize Redis client: {e}")
     raise
@@ -49,6 +68,34 @@ class UserFlag(str, Enum):
     ADMINISTRATOR = "ADMINISTRATOR"
     SYSTEM_OPERATOR = "SYSTEM_OPERATOR"
 
+# Lookup table for parsing stored flag strings without going through UserFlag()
+_FLAG_BY_VALUE = {flag.value: flag for flag in UserFlag}
+
+# Flags are cached in Redis as a bitmask, one bit per flag in declaration order.
+# New flags must be added at the end of UserFlag so existing masks keep their meaning.
+_FLAG_BITS = {flag: 1 << index for index, flag in enumerate(UserFlag)}
+_FLAGS_BY_MASK = [
+    [flag for flag, bit in _FLAG_BITS.items() if mask & bit]
+    for mask in range(1 << len(_FLAG_BITS))
+]
+
+def flags_to_mask(flags: List[UserFlag]) -> int:
+    """Pack flags into a bitmask."""
+    mask = 0
+    for flag in flags:
+        mask |= _FLAG_BITS[flag]
+    return mask
+
+def flags_from_mask(mask: int) -> List[UserFlag]:
+    """Unpack a bitmask into flags."""
+    return list(_FLAGS_BY_MASK[mask])
+
+class RateTier(IntEnum):
+    UNAUTHENTICATED = 0
+    USER = 1
+    ELEVATED = 2
+    UNLIMITED = 3
+
 class RateLimits:
     FLAG_LIMITS = {
         UserFlag.USER: 100,            # 100 requests per minute
@@ -58,10 +105,61 @@ class RateLimits:
     }
     UNAUTHENTICATED_LIMIT = 10        # 10 requests per minute
 
+    TIER_LIMITS = {
+        RateTier.UNAUTHENTICATED: UNAUTHENTICATED_LIMIT,
+        RateTier.USER: FLAG_LIMITS[UserFlag.USER],
+        RateTier.ELEVATED: FLAG_LIMITS[UserFlag.ELEVATED_USER],
+        RateTier.UNLIMITED: -1
+    }
+
+# Each flag's tier, derived from its limit in FLAG_LIMITS so the two can't disagree
+_TIER_BY_LIMIT = {limit: tier for tier, limit in RateLimits.TIER_LIMITS.items()}
+_missing_limits = set(UserFlag) - set(RateLimits.FLAG_LIMITS)
+if _missing_limits:
+    raise ValueError(f"RateLimits.FLAG_LIMITS has no limit for {sorted(flag.value for flag in _missing_limits)}")
+_untiered_limits = set(RateLimits.FLAG_LIMITS.values()) - set(_TIER_BY_LIMIT)
+if _untiered_limits:
+    raise ValueError(f"RateLimits.TIER_LIMITS has no tier for limits {sorted(_untiered_limits)}")
+FLAG_TIERS = {flag: _TIER_BY_LIMIT[limit] for flag, limit in RateLimits.FLAG_LIMITS.items()}
+
+def tier_for_flags(flags: List[UserFlag]) -> RateTier:
+    """Get the highest rate limit tier granted by a set of flags."""
+    return max((FLAG_TIERS[flag] for flag in flags), default=RateTier.UNAUTHENTICATED)
+
+# How long a user's flags are cached in Redis before Firestore is consulted again
+USER_FLAGS_CACHE_TTL = 60  # seconds
+# Upper bound on how long a resolved API key (user_id + flags) is cached
+AUTH_CONTEXT_CACHE_TTL = 60  # seconds
+# How long this process reuses a resolved API key before asking Redis again. Kept
+# short so authctx:* in Redis, shared by every worker, stays the source of truth:
+# revoke_api_key and invalidate_user_flags delete those entries, and other workers'
+# local copies then lapse within about a second.
+LOCAL_AUTH_CACHE_TTL = 1  # seconds
+
+# Per-process auth contexts keyed by API key hash, in front of the authctx:* keys.
+# Keys that turned out not to exist are cached as False so bad keys don't hit Redis every time.
+_local_auth_cache = TTLCache(maxsize=10000, ttl=LOCAL_AUTH_CACHE_TTL)
+
+@dataclass(frozen=True)
+class AuthContext:
+    """Everything resolved about the caller of a request."""
+    api_key: Optional[str] = None
+    key_hash: Optional[str] = None
+    user_id: Optional[str] = None
+    flags: List[UserFlag] = field(default_factory=list)
+    tier: RateTier = RateTier.UNAUTHENTICATED
+    # Set when the key could not be resolved because Redis or Firestore failed
+    degraded: bool = False
+
+def hash_api_key(api_key: str) -> str:
+    """Hash an API key, Redis only ever stores this digest and never the key itself."""
+    return hashlib.blake2b(api_key.encode(), digest_size=16).hexdigest()
+
 async def create_api_key(user_id: str, expires_in_days: int = 30) -> str:
     """Create a new API key for a user."""
     try:
         api_key = f"key_{secrets.token_urlsafe(32)}"
+        key_hash = hash_api_key(api_key)
         expires_at = int(time.time()) + (expires_in_days * 24 * 60 * 60)
         
         # Store API key in Redis with user_id and expiration
@@ -71,129 +169,294 @@ async def create_api_key(user_id: str, expires_in_days: int = 30) -> str:
             "expires_at": expires_at
         }
         
-        await redis_client.set(
-            f"apikey:{api_key}",
-            json.dumps(key_data),
-            ex=expires_in_days * 24 * 60 * 60
-        )
+        # Store the key and index it under its owner in one round-trip
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(f"apikey:{key_hash}", mapping=key_data)
+            pipe.expire(f"apikey:{key_hash}", expires_in_days * 24 * 60 * 60)
+            pipe.sadd(f"user_keys:{user_id}", key_hash)
+            await pipe.execute()
         
+        # Only the caller ever sees the plaintext key
         return api_key
     except Exception as e:
         print(f"Error creating API key: {e}")
         raise HTTPException(status_code=500, detail="Failed to create API key")
 
 async def get_api_key(request: Request) -> Optional[str]:
-    """Extract API key from request header."""
+    """Extract API key from request header.
+
+    Use as a dependency so the header is read once per request and shared.
+    """
     api_key = request.headers.get("X-API-Key")
     if not api_key:
         return None
     return api_key
 
+async def get_user_flags_cached(user_id: str) -> List[UserFlag]:
+    """Get a user's flags, served from Redis when possible."""
+    cached = await redis_client.get(f"uflags:{user_id}")
+    if cached is not None:
+        return flags_from_mask(int(cached))
+
+    # Cache miss, read the user document from Firestore
+    user_doc = await get_db().collection('users').document(user_id).get(field_paths=['flags'])
+    flag_values = user_doc.to_dict().get('flags', []) if user_doc.exists else []
+    flags = [_FLAG_BY_VALUE[flag] for flag in flag_values]
+
+    await redis_client.set(f"uflags:{user_id}", flags_to_mask(flags), ex=USER_FLAGS_CACHE_TTL)
+    return flags
+
+async def invalidate_user_flags(*user_ids: str):
+    """Drop users' cached flags, call this whenever their flags change.
+
+    The auth contexts of all their API keys carry the flags and tier too, so
+    those are dropped along with the flags themselves.
+    """
+    if not user_ids:
+        return
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for user_id in user_ids:
+            pipe.smembers(f"user_keys:{user_id}")
+        key_sets = await pipe.execute()
+
+    key_hashes = [key_hash for key_set in key_sets for key_hash in key_set]
+    for key_hash in key_hashes:
+        _local_auth_cache.pop(key_hash, None)
+
+    await redis_client.delete(
+        *(f"uflags:{user_id}" for user_id in user_ids),
+        *(f"authctx:{key_hash}" for key_hash in key_hashes)
+    )
+
+async def _load_auth_context(key_hash: str) -> Optional[dict]:
+    """Resolve a hashed API key to its user_id, flags and expiry in a single cached lookup."""
+    ctx = _local_auth_cache.get(key_hash)
+    if ctx is False:
+        return None
+    if ctx is not None and ctx["expires_at"] > time.time():
+        return ctx
+
+    # Read the cached context and the key record together so a miss costs no extra round-trip
+    ctx_key = f"authctx:{key_hash}"
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.get(ctx_key)
+        pipe.hmget(f"apikey:{key_hash}", "user_id", "expires_at")
+        cached, (user_id, expires_at) = await pipe.execute()
+
+    if cached is not None:
+        ctx = _local_auth_cache[key_hash] = orjson.loads(cached)
+        return ctx
+
+    # Expired keys are evicted by the TTL set in create_api_key, so a hit is always live
+    if not user_id:
+        _local_auth_cache[key_hash] = False
+        return None
+
+    flags = await get_user_flags_cached(user_id)
+    ctx = {
+        "user_id": user_id,
+        "flags": flags_to_mask(flags),
+        "tier": int(tier_for_flags(flags)),
+        "expires_at": int(expires_at)
+    }
+
+    # Never cache the context past the key's own expiry
+    ttl = max(1, min(ctx["expires_at"] - int(time.time()), AUTH_CONTEXT_CACHE_TTL))
+    await redis_client.set(ctx_key, orjson.dumps(ctx), ex=ttl)
+    _local_auth_cache[key_hash] = ctx
+    return ctx
+
+async def get_auth_context(api_key: str) -> Optional[dict]:
+    """Resolve an API key to its user_id, flags and expiry in a single cached lookup."""
+    return await _load_auth_context(hash_api_key(api_key))
+
 async def get_user_flags(api_key: Optional[str] = None) -> List[UserFlag]:
     """Get user flags based on API key."""
     if not api_key:
         return []
-        
-    user_id = await validate_api_key(api_key)
-    if not user_id:
-        return []
-    
-    # Get user flags from Firestore
-    user_doc = db.collection('users').document(user_id).get()
-    if not user_doc.exists:
+
+    ctx = await get_auth_context(api_key)
+    if not ctx:
         return []
-        
-    user_data = user_doc.to_dict()
-    return [UserFlag(flag) for flag in user_data.get('flags', [])]
+
+    return flags_from_mask(ctx["flags"])
 
 async def validate_api_key(api_key: str) -> Optional[str]:
     """Validate API key and return user_id if valid."""
     if not api_key:
         return None
-        
-    key_data = await redis_client.get(f"apikey:{api_key}")
-    if not key_data:
-        return None
-        
-    key_data = json.loads(key_data)
-    
-    # Check if key has expired
-    if int(time.time()) > key_data["expires_at"]:
-        await redis_client.delete(f"apikey:{api_key}")
+
+    ctx = await get_auth_context(api_key)
+    if not ctx:
         return None
-        
-    return key_data["user_id"]
+
+    return ctx["user_id"]
+
+async def current_auth(api_key: Optional[str] = Depends(get_api_key)) -> AuthContext:
+    """Resolve the caller of a request.
+
+    Use as a dependency: FastAPI caches it per request, so the API key is
+    only looked up once however many dependencies need it.
+    """
+    if not api_key:
+        return AuthContext()
+
+    key_hash = hash_api_key(api_key)
+    try:
+        ctx = await _load_auth_context(key_hash)
+    except Exception as e:
+        print(f"Error resolving auth context: {e}")
+        # Rate limit the caller as unauthenticated, the most restrictive option,
+        # but mark it so flag checks report the outage instead of a 403
+        return AuthContext(api_key=api_key, key_hash=key_hash, degraded=True)
+
+    if not ctx:
+        return AuthContext(api_key=api_key, key_hash=key_hash)
+
+    return AuthContext(
+        api_key=api_key,
+        key_hash=key_hash,
+        user_id=ctx["user_id"],
+        flags=flags_from_mask(ctx["flags"]),
+        tier=RateTier(ctx["tier"])
+    )
 
 async def revoke_api_key(api_key: str):
-    """Revoke an API key."""
-    await redis_client.delete(f"apikey:{api_key}")
+    """Revoke an API key, given either the plaintext key or its hash."""
+    key_hash = hash_api_key(api_key) if api_key.startswith("key_") else api_key
+    _local_auth_cache.pop(key_hash, None)
+    user_id = await redis_client.hget(f"apikey:{key_hash}", "user_id")
+
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(f"apikey:{key_hash}", f"authctx:{key_hash}")
+        if user_id:
+            pipe.srem(f"user_keys:{user_id}", key_hash)
+        await pipe.execute()
 
 async def list_user_api_keys(user_id: str) -> List[dict]:
     """List all API keys for a user."""
+    key_hashes = list(await redis_client.smembers(f"user_keys:{user_id}"))
+    if not key_hashes:
+        return []
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key_hash in key_hashes:
+            pipe.hgetall(f"apikey:{key_hash}")
+        results = await pipe.execute()
+
     keys = []
-    async for key in redis_client.scan_iter(match="apikey:*"):
-        key_data = await redis_client.get(key)
-        if key_data:
-            key_data = json.loads(key_data)
-            if key_data["user_id"] == user_id:
-                keys.append({
-                    "key": key.split(":", 1)[1],
-                    **key_data
-                })
+    expired = []
+    for key_hash, key_data in zip(key_hashes, results):
+        if not key_data:
+            # Key expired out of Redis, drop it from the index
+            expired.append(key_hash)
+            continue
+        keys.append({
+            "key_hash": key_hash,
+            "user_id": key_data["user_id"],
+            "created_at": int(key_data["created_at"]),
+            "expires_at": int(key_data["expires_at"])
+        })
+
+    if expired:
+        await redis_client.srem(f"user_keys:{user_id}", *expired)
     return keys
 
+# Start with just one test user
+_TEST_USERS = [
+    {
+        "id": "test_admin",
+        "flags": [UserFlag.USER, UserFlag.ADMINISTRATOR],
+        "email": "admin@example.com"
+    }
+]
+# The Firestore documents and ids for the test users, built once
+_TEST_USER_DOCS = [
+    (test_user['id'], {
+        'email': test_user['email'],
+        'flags': [flag.value for flag in test_user['flags']]
+    })
+    for test_user in _TEST_USERS
+]
+_TEST_USER_IDS = [user_id for user_id, _ in _TEST_USER_DOCS]
+
 async def create_test_users() -> Dict[str, str]:
     """Create test users with different flags and API keys."""
     try:
-        # Start with just one test user
-        test_user = {
-            "id": "test_admin",
-            "flags": [UserFlag.USER, UserFlag.ADMINISTRATOR],
-            "email": "admin@example.com"
-        }
-        
-        # Create or update user in Firestore
-        db.collection('users').document(test_user['id']).set({
-            'email': test_user['email'],
-            'flags': [flag.value for flag in test_user['flags']]
-        })
+        # Create or update all users in Firestore with a single batched write
+        db = get_db()
+        batch = db.batch()
+        for user_id, user_doc in _TEST_USER_DOCS:
+            batch.set(db.collection('users').document(user_id), user_doc)
+        await batch.commit()
+        await invalidate_user_flags(*_TEST_USER_IDS)
         
-        # Create API key
-        api_key = await create_api_key(test_user['id'], expires_in_days=365)
+        # Create API keys concurrently
+        api_keys = await asyncio.gather(*(
+            create_api_key(user_id, expires_in_days=365) for user_id in _TEST_USER_IDS
+        ))
         
-        return {test_user['id']: api_key}
+        return dict(zip(_TEST_USER_IDS, api_keys))
     except Exception as e:
         print(f"Error in create_test_users: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 def requires_flags(required_flags: List[UserFlag], any_of: bool = False):
     """Decorator to require specific user flags."""
+    required_set = frozenset(required_flags)
     def decorator(func):
+        signature = inspect.signature(func)
+
+        # Locate the Request parameter once instead of scanning args on every call
+        request_name, request_index = 'request', None
+        for index, param in enumerate(signature.parameters.values()):
+            if param.annotation is Request:
+                request_name = param.name
+                if param.kind in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD):
+                    request_index = index
+                break
+
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            request = kwargs.get('request')
-            if not request:
-                for arg in args:
-                    if isinstance(arg, Request):
-                        request = arg
-                        break
-            
-            api_key = await get_api_key(request)
-            user_flags = await get_user_flags(api_key)
-            
+            auth_ctx = kwargs.pop('_auth_ctx', None)
+            if auth_ctx is None:
+                # Called directly rather than by FastAPI, resolve from the request
+                request = kwargs.get(request_name)
+                if request is None and request_index is not None and request_index < len(args):
+                    request = args[request_index]
+                auth_ctx = await current_auth(await get_api_key(request))
+
+            if auth_ctx.degraded:
+                raise HTTPException(status_code=503, detail="Authentication is temporarily unavailable")
+
+            user_flags = auth_ctx.flags
+
             if any_of:
-                if not any(flag in user_flags for flag in required_flags):
+                if required_set.isdisjoint(user_flags):
                     raise HTTPException(
                         status_code=403,
                         detail=f"This endpoint requires any of these flags: {[flag.value for flag in required_flags]}"
                     )
             else:
-                if not all(flag in user_flags for flag in required_flags):
+                if not required_set.issubset(user_flags):
                     raise HTTPException(
                         status_code=403,
                         detail=f"This endpoint requires all these flags: {[flag.value for flag in required_flags]}"
                     )
             
             return await func(*args, **kwargs)
+
+        # Expose the auth context to FastAPI as an extra dependency so it is shared
+        # with the rest of the request instead of being resolved again here
+        params = [p for p in signature.parameters.values() if p.kind != inspect.Parameter.VAR_KEYWORD]
+        params.append(inspect.Parameter(
+            '_auth_ctx',
+            inspect.Parameter.KEYWORD_ONLY,
+            default=Depends(current_auth),
+            annotation=AuthContext
+        ))
+        params.extend(p for p in signature.parameters.values() if p.kind == inspect.Parameter.VAR_KEYWORD)
+        wrapper.__signature__ = signature.replace(parameters=params)
         return wrapper
     return decorator
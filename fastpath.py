@@ -0,0 +1,24 @@
+"""Pure string helpers behind /format-number and /unformat-number.
+
+Kept free of FastAPI and fully typed so the module can be compiled to a C
+extension with mypyc (`mypyc fastpath.py`). When compiled it is picked up in
+place of this file, otherwise it runs as plain Python.
+"""
+# Deletion table for everything but ASCII digits and the decimal point
+_ASCII_NON_NUMERIC = str.maketrans('', '', ''.join(chr(i) for i in range(128) if chr(i) not in '0123456789.'))
+
+def format_number(value: float, decimal_places: int) -> str:
+    """Format a number with thousands separators and a fixed precision."""
+    # Constant format specs for the common precisions are parsed at compile time
+    if decimal_places == 2:
+        return f"{value:,.2f}"
+    if decimal_places == 0:
+        return f"{value:,.0f}"
+    return f"{value:,.{decimal_places}f}"
+
+def unformat_number(value: str) -> str:
+    """Remove all non-numeric characters except the decimal point."""
+    if value.isascii():
+        return value.translate(_ASCII_NON_NUMERIC)
+    # Anything that str.isdigit accepts counts as a digit, e.g. superscripts too
+    return ''.join(char for char in value if char.isdigit() or char == '.')
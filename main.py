@@ -1,81 +1,90 @@
 from fastapi import FastAPI, Depends, Request, HTTPException
-from pydantic import BaseModel, RootModel
+from fastapi.responses import ORJSONResponse, JSONResponse
+from pydantic import BaseModel
 from typing import Optional
-import os
-from fastapi_limiter import FastAPILimiter
-from fastapi_limiter.depends import RateLimiter
-from auth import UserFlag, get_user_flags, get_api_key, RateLimits, create_test_users
-import redis.asyncio as redis
+from contextlib import asynccontextmanager
+import math
+import re
+import logging
+import msgspec
+from redis.exceptions import RedisError
+import fastpath
+from auth import UserFlag, AuthContext, RateTier, current_auth, create_test_users, redis_client, redis_pool
+from rate_limit import load_rate_limit_script, hit_rate_limit, get_client_identifier
 
-app = FastAPI(
-    title="Test API",
-    description="A simple test API with basic endpoints",
-    docs_url=None,    # Disable Swagger UI
-    redoc_url=None,   # Disable ReDoc
-    openapi_url=None  # Disable OpenAPI schema
-)
+log = logging.getLogger(__name__)
 
-# Initialize rate limiter on startup
-@app.on_event("startup")
-async def startup():
-    redis_url = os.environ.get("REDIS_URL")
-    if not redis_url:
-        raise ValueError("REDIS_URL environment variable is not set")
-    
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Check Redis and load the rate limit script on startup, close the pool on shutdown."""
     try:
-        redis_instance = redis.from_url(
-            redis_url,
-            encoding="utf-8",
-            decode_responses=True,
-            socket_connect_timeout=5,  # Reduce timeout
-            socket_keepalive=True      # Keep connection alive
-        )
         # Test the connection
-        await redis_instance.ping()
-        await FastAPILimiter.init(redis_instance)
+        await redis_client.ping()
+        await load_rate_limit_script(redis_client)
         print("Successfully connected to Redis")
     except Exception as e:
         print(f"Failed to connect to Redis: {e}")
         raise
 
-async def get_rate_limit(request: Request):
+    yield
+
+    await redis_pool.disconnect()
+
+app = FastAPI(
+    title="Test API",
+    description="A simple test API with basic endpoints",
+    docs_url=None,    # Disable Swagger UI
+    redoc_url=None,   # Disable ReDoc
+    openapi_url=None,  # Disable OpenAPI schema
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
+
+async def get_rate_limit(request: Request, ctx: AuthContext = Depends(current_auth)):
     """Dynamic rate limiting based on user flags"""
+    # Unlimited callers never touch the limiter
+    if ctx.tier >= RateTier.UNLIMITED:
+        return None
+
+    # Authenticated callers are limited per key, everyone else per IP
+    if ctx.tier > RateTier.UNAUTHENTICATED:
+        identifier = f"key:{ctx.key_hash}"
+    else:
+        identifier = f"ip:{get_client_identifier(request)}"
     try:
-        api_key = await get_api_key(request)
-        user_flags = await get_user_flags(api_key)
-        
-        # Get highest rate limit from user's flags
-        rate_limit = RateLimits.UNAUTHENTICATED_LIMIT
-        for flag in user_flags:
-            flag_limit = RateLimits.FLAG_LIMITS.get(flag, 0)
-            if flag_limit == -1:  # Unlimited for ADMINISTRATOR and SYSTEM_OPERATOR
-                return None
-            rate_limit = max(rate_limit, flag_limit)
-        
-        return RateLimiter(times=rate_limit, minutes=1)
-    except Exception as e:
-        print(f"Rate limit error: {str(e)}")
-        # Default to most restrictive limit on error
-        return RateLimiter(times=RateLimits.UNAUTHENTICATED_LIMIT, minutes=1)
+        allowed, retry_after_ms = await hit_rate_limit(redis_client, identifier, ctx.tier)
+    except RedisError as e:
+        # Fail open: a limiter outage shouldn't take every endpoint down with it
+        log.warning("Rate limiter unavailable, allowing request: %s", e)
+        return None
+    if not allowed:
+        raise HTTPException(
+            status_code=429,
+            detail="Too Many Requests",
+            headers={"Retry-After": str(math.ceil(retry_after_ms / 1000))}
+        )
+
+# A webhook variable name surrounded by curly brackets; only used to validate, the
+# bare name is sliced out below
+_VARIABLE_NAME = re.compile(r'\{.*\}', re.DOTALL)
 
 class Message(BaseModel):
     content: str
 
 class Number(BaseModel):
     value: float
-    decimal_places: Optional[int] = 2
+    decimal_places: int = 2
 
 class UnformattedNumber(BaseModel):
     value: str
 
-class WebhookRequest(RootModel):
-    root: dict
-
 @app.get("/")
 async def read_root(request: Request, _=Depends(get_rate_limit)):
     return {"message": "Welcome to the Test API"}
 
-@app.post("/echo")
+# /echo and /webhook send caller-supplied JSON back, which may hold integers wider
+# than 64 bits that orjson can't encode, so they keep the stdlib encoder
+@app.post("/echo", response_class=JSONResponse)
 async def echo_message(request: Request, message: Optional[Message] = None, params: dict = None, _=Depends(get_rate_limit)):
     response = {}
     if message:
@@ -86,37 +95,39 @@ async def echo_message(request: Request, message: Optional[Message] = None, para
 
 @app.post("/format-number")
 async def format_number(request: Request, number: Number, _=Depends(get_rate_limit)):
-    formatted = "{:,.{precision}f}".format(number.value, precision=number.decimal_places)
+    formatted = fastpath.format_number(number.value, number.decimal_places)
     return {"formatted": formatted}
 
 @app.post("/unformat-number")
 async def unformat_number(request: Request, number: UnformattedNumber, _=Depends(get_rate_limit)):
     # Remove all non-numeric characters except decimal point
-    unformatted = ''.join(char for char in number.value if char.isdigit() or char == '.')
+    unformatted = fastpath.unformat_number(number.value)
     return {"unformatted": unformatted}
 
-@app.post("/webhook")
-async def webhook(request: Request, webhook_request: WebhookRequest, _=Depends(get_rate_limit)):
-    variables = []
-    
-    for var_name, value in webhook_request.root.items():
-        # Check if variable name is surrounded by curly brackets
-        if not (var_name.startswith("{") and var_name.endswith("}")):
-            return {"error": f"Variable name '{var_name}' must be surrounded by curly brackets"}
-        
-        # Strip the curly brackets to get the clean variable name
-        clean_var_name = var_name[1:-1]
-        
-        variable_obj = {
-            "name": clean_var_name,
-            "variable": var_name,
-            "value": value
-        }
-        variables.append(variable_obj)
-        
-        # Print the variable object to console
-        print(f"Processed variable: {variable_obj}")
-    
+@app.post("/webhook", response_class=JSONResponse)
+async def webhook(request: Request, _=Depends(get_rate_limit)):
+    # Arbitrary name -> value pairs, decoded straight to a dict without a pydantic model
+    try:
+        payload = msgspec.json.decode(await request.body(), type=dict)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    # Check every variable name is surrounded by curly brackets before building anything
+    invalid = next((var_name for var_name in payload if not _VARIABLE_NAME.fullmatch(var_name)), None)
+    if invalid is not None:
+        return {"error": f"Variable name '{invalid}' must be surrounded by curly brackets"}
+
+    # Strip the curly brackets to get the clean variable names
+    variables = [
+        {"name": var_name[1:-1], "variable": var_name, "value": value}
+        for var_name, value in payload.items()
+    ]
+
+    # Only pay for formatting when debug logging is actually on
+    if log.isEnabledFor(logging.DEBUG):
+        for variable_obj in variables:
+            log.debug("Processed variable: %s", variable_obj)
+
     return {"variables": variables}
 
 @app.post("/create-test-users")
@@ -1,29 +1,95 @@
 from fastapi import Request
-from fastapi_limiter import FastAPILimiter
-from fastapi_limiter.depends import RateLimiter
 import redis.asyncio as redis
-import os
-from auth import UserFlag, get_user_flags, RateLimits
-
-async def setup_rate_limiter():
-    """Initialize the Redis connection for rate limiting."""
-    redis_instance = redis.from_url(os.getenv("REDIS_URL"), encoding="utf-8", decode_responses=True)
-    await FastAPILimiter.init(redis_instance)
-
-async def dynamic_rate_limit(request: Request):
-    """Get rate limit based on user flags."""
-    api_key = request.headers.get("X-API-Key")
-    user_flags = await get_user_flags(api_key)
-    
-    if not user_flags:
-        return RateLimiter(times=RateLimits.UNAUTHENTICATED_LIMIT, minutes=1)
-    
-    # Get the highest rate limit from user's flags
-    rate_limit = RateLimits.UNAUTHENTICATED_LIMIT
-    for flag in user_flags:
-        flag_limit = RateLimits.FLAG_LIMITS.get(flag, 0)
-        if flag_limit == -1:  # Unlimited for SYSTEM_OPERATOR
-            return None
-        rate_limit = max(rate_limit, flag_limit)
-    
-    return RateLimiter(times=rate_limit, minutes=1)
+from redis.exceptions import NoScriptError
+import math
+import time
+from cachetools import TTLCache
+from typing import Optional, Tuple
+from auth import RateLimits, RateTier
+
+# Token bucket stored as a hash of {tokens, ts}. The bucket is refilled for the
+# time elapsed since ts, one token is taken if available, and the key expires once
+# it would be full again. Returns {allowed, retry_after_ms}.
+TOKEN_BUCKET_SCRIPT = """
+local key = KEYS[1]
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+
+local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = math.ceil((1 - tokens) / rate)
+end
+
+redis.call('HSET', key, 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', key, math.ceil((capacity - tokens) / rate) + 1)
+return {allowed, retry_after}
+"""
+
+_script_sha: Optional[str] = None
+
+# Callers known to be over their limit, mapped to the monotonic time they may retry.
+# Lets floods be rejected in-process without a Redis round-trip.
+_denied_until = TTLCache(maxsize=10000, ttl=60)
+
+async def load_rate_limit_script(redis_instance: redis.Redis):
+    """Load the rate limit script into Redis and remember its SHA."""
+    global _script_sha
+    _script_sha = await redis_instance.script_load(TOKEN_BUCKET_SCRIPT)
+
+def get_client_identifier(request: Request) -> str:
+    """Get the client IP, honouring X-Forwarded-For when behind a proxy.
+
+    Only the right-most entry is used: it is the one appended by our proxy, every
+    entry before it is whatever the client chose to send.
+    """
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded:
+        client_ip = forwarded.rsplit(",", 1)[-1].strip()
+        if client_ip:
+            return client_ip
+    return request.client.host if request.client else "unknown"
+
+def bucket_for_limit(limit: int) -> Tuple[int, float]:
+    """Turn a requests-per-minute limit into (capacity, tokens refilled per ms)."""
+    return limit, limit / 60000
+
+# Bucket parameters for every limited tier, worked out once at import
+TIER_BUCKETS = {
+    tier: bucket_for_limit(limit)
+    for tier, limit in RateLimits.TIER_LIMITS.items()
+    if limit != -1
+}
+
+async def hit_rate_limit(redis_instance: redis.Redis, identifier: str, tier: RateTier) -> Tuple[bool, int]:
+    """Take a token from identifier's bucket, returning (allowed, retry_after_ms)."""
+    deny_until = _denied_until.get(identifier)
+    if deny_until is not None:
+        remaining = deny_until - time.monotonic()
+        if remaining > 0:
+            return False, math.ceil(remaining * 1000)
+
+    if _script_sha is None:
+        await load_rate_limit_script(redis_instance)
+
+    capacity, refill_per_ms = TIER_BUCKETS[tier]
+    args = (f"bucket:{identifier}", capacity, refill_per_ms, int(time.time() * 1000))
+    try:
+        allowed, retry_after_ms = await redis_instance.evalsha(_script_sha, 1, *args)
+    except NoScriptError:
+        # Redis was restarted or flushed, reload and try once more
+        await load_rate_limit_script(redis_instance)
+        allowed, retry_after_ms = await redis_instance.evalsha(_script_sha, 1, *args)
+
+    if not allowed:
+        _denied_until[identifier] = time.monotonic() + retry_after_ms / 1000
+    return bool(allowed), int(retry_after_ms)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# auth.py refuses to import without REDIS_URL; the client is lazy so nothing connects
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+import auth
+from auth import RateTier, UserFlag
+
+
+@pytest.fixture
+def user_flags(monkeypatch):
+    """Replace Redis with fakeredis and Firestore with a dict of user_id -> flags."""
+    monkeypatch.setattr(auth, "redis_client", fakeredis.aioredis.FakeRedis(decode_responses=True))
+    auth._local_auth_cache.clear()
+
+    flags = {}
+
+    async def get_user_flags_cached(user_id):
+        return list(flags.get(user_id, []))
+
+    monkeypatch.setattr(auth, "get_user_flags_cached", get_user_flags_cached)
+    return flags
+
+
+def test_invalidate_user_flags_drops_cached_auth_contexts(user_flags):
+    async def scenario():
+        user_flags["u1"] = [UserFlag.USER, UserFlag.ADMINISTRATOR]
+        api_key = await auth.create_api_key("u1")
+        assert (await auth.get_auth_context(api_key))["tier"] == RateTier.UNLIMITED
+
+        user_flags["u1"] = [UserFlag.USER]
+        await auth.invalidate_user_flags("u1")
+
+        assert await auth.redis_client.get(f"authctx:{auth.hash_api_key(api_key)}") is None
+        assert (await auth.get_auth_context(api_key))["tier"] == RateTier.USER
+
+    asyncio.run(scenario())
+
+
+def test_invalidate_user_flags_leaves_other_users_alone(user_flags):
+    async def scenario():
+        user_flags["u2"] = [UserFlag.ELEVATED_USER]
+        api_key = await auth.create_api_key("u2")
+        await auth.get_auth_context(api_key)
+
+        await auth.invalidate_user_flags("u1")
+
+        assert await auth.redis_client.get(f"authctx:{auth.hash_api_key(api_key)}") is not None
+
+    asyncio.run(scenario())
+
+
+def test_every_flag_tier_matches_its_limit():
+    for flag, limit in auth.RateLimits.FLAG_LIMITS.items():
+        assert auth.RateLimits.TIER_LIMITS[auth.FLAG_TIERS[flag]] == limit
+    assert set(auth.FLAG_TIERS) == set(UserFlag)
+
+
+@pytest.mark.parametrize("flags, tier", [
+    ([], RateTier.UNAUTHENTICATED),
+    ([UserFlag.USER], RateTier.USER),
+    ([UserFlag.USER, UserFlag.ELEVATED_USER], RateTier.ELEVATED),
+    ([UserFlag.USER, UserFlag.SYSTEM_OPERATOR], RateTier.UNLIMITED),
+])
+def test_tier_for_flags_takes_the_highest_tier(flags, tier):
+    assert auth.tier_for_flags(flags) == tier
+
+
+def test_redis_pool_queues_commands_past_max_connections():
+    async def scenario():
+        # Same pool class and limits as auth.redis_pool, over in-memory connections
+        pool = type(auth.redis_pool)(
+            connection_class=getattr(fakeredis.aioredis, "FakeAsyncRedisConnection", fakeredis.aioredis.FakeConnection),
+            server=fakeredis.FakeServer(),
+            max_connections=auth.redis_pool.max_connections,
+            timeout=auth.redis_pool.timeout,
+            decode_responses=True,
+        )
+        client = auth.redis.Redis(connection_pool=pool)
+
+        burst = auth.redis_pool.max_connections * 3
+        await asyncio.gather(*(client.incr("n") for _ in range(burst)))
+
+        assert await client.get("n") == str(burst)
+        await pool.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_requires_flags_reports_backend_failure_as_503(monkeypatch):
+    async def failing_load(key_hash):
+        raise auth.redis.ConnectionError("Redis is down")
+
+    monkeypatch.setattr(auth, "_load_auth_context", failing_load)
+
+    @auth.requires_flags([UserFlag.ADMINISTRATOR])
+    async def admin_only():
+        return "ok"
+
+    async def scenario():
+        ctx = await auth.current_auth("key_admin")
+        # Still limited as the most restrictive tier
+        assert ctx.tier == RateTier.UNAUTHENTICATED
+        with pytest.raises(auth.HTTPException) as exc_info:
+            await admin_only(_auth_ctx=ctx)
+        assert exc_info.value.status_code == 503
+
+    asyncio.run(scenario())
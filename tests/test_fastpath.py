@@ -0,0 +1,29 @@
+import pytest
+
+import fastpath
+
+
+def isdigit_filter(value):
+    return ''.join(char for char in value if char.isdigit() or char == '.')
+
+
+@pytest.mark.parametrize("value", [
+    "$1,234.56",
+    "abc",
+    "",
+    "1.2.3 x",
+    "x²3",
+    "١٢٣.٤",
+    "①2",
+])
+def test_unformat_number_keeps_what_isdigit_keeps(value):
+    assert fastpath.unformat_number(value) == isdigit_filter(value)
+
+
+@pytest.mark.parametrize("value, decimal_places, expected", [
+    (1234567.891, 2, "1,234,567.89"),
+    (1234.5, 0, "1,234"),
+    (1.23456, 3, "1.235"),
+])
+def test_format_number(value, decimal_places, expected):
+    assert fastpath.format_number(value, decimal_places) == expected
@@ -0,0 +1,53 @@
+import pytest
+
+pytest.importorskip("httpx")  # needed by TestClient
+
+from fastapi.testclient import TestClient
+
+import main
+
+BIG_INT = 2 ** 80
+
+
+@pytest.fixture
+def client():
+    # Skip rate limiting so no Redis is needed, and skip the lifespan by not entering the client
+    main.app.dependency_overrides[main.get_rate_limit] = lambda: None
+    yield TestClient(main.app)
+    main.app.dependency_overrides.clear()
+
+
+def test_echo_returns_integers_wider_than_64_bits(client):
+    response = client.post("/echo", json={"params": {"n": BIG_INT}})
+    assert response.status_code == 200
+    assert response.json() == {"params": {"n": BIG_INT}}
+
+
+def test_webhook_returns_integers_wider_than_64_bits(client):
+    response = client.post("/webhook", json={"{n}": BIG_INT})
+    assert response.status_code == 200
+    assert response.json() == {"variables": [{"name": "n", "variable": "{n}", "value": BIG_INT}]}
+
+
+def test_rate_limiter_failure_lets_requests_through(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    import rate_limit
+
+    class BrokenRedis(fakeredis.aioredis.FakeRedis):
+        async def evalsha(self, *args, **kwargs):
+            raise main.RedisError("Connection reset by peer")
+
+    monkeypatch.setattr(main, "redis_client", BrokenRedis())
+    rate_limit._denied_until.clear()
+    main.app.dependency_overrides[main.current_auth] = lambda: main.AuthContext()
+    try:
+        response = TestClient(main.app).get("/")
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert response.status_code == 200
+
+
+def test_format_number_rejects_null_decimal_places(client):
+    response = client.post("/format-number", json={"value": 1.5, "decimal_places": None})
+    assert response.status_code == 422
@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")  # fakeredis needs it to run the Lua script
+
+import rate_limit
+from auth import RateLimits, RateTier
+
+
+class FakeClock:
+    """Stands in for the time module so wall and monotonic time move together."""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, "time", clock)
+    monkeypatch.setattr(rate_limit, "_script_sha", None)
+    rate_limit._denied_until.clear()
+    return clock
+
+
+@pytest.fixture
+def redis_instance():
+    return fakeredis.aioredis.FakeRedis(decode_responses=True)
+
+
+def hit(redis_instance, identifier, tier):
+    return asyncio.run(rate_limit.hit_rate_limit(redis_instance, identifier, tier))
+
+
+def test_full_bucket_allows_capacity_then_denies(clock, redis_instance):
+    limit = RateLimits.TIER_LIMITS[RateTier.USER]
+    for _ in range(limit):
+        assert hit(redis_instance, "key:a", RateTier.USER) == (True, 0)
+
+    allowed, retry_after_ms = hit(redis_instance, "key:a", RateTier.USER)
+    assert not allowed
+    # One token refills every 60000 / limit ms
+    assert retry_after_ms == 60000 // limit
+
+
+def test_bucket_refills_over_time(clock, redis_instance):
+    limit = RateLimits.TIER_LIMITS[RateTier.USER]
+    for _ in range(limit):
+        hit(redis_instance, "key:a", RateTier.USER)
+    assert not hit(redis_instance, "key:a", RateTier.USER)[0]
+
+    clock.advance(60 / limit)
+    assert hit(redis_instance, "key:a", RateTier.USER) == (True, 0)
+    assert not hit(redis_instance, "key:a", RateTier.USER)[0]
+
+
+def test_buckets_are_per_identifier(clock, redis_instance):
+    limit = RateLimits.TIER_LIMITS[RateTier.UNAUTHENTICATED]
+    for _ in range(limit):
+        hit(redis_instance, "ip:1.1.1.1", RateTier.UNAUTHENTICATED)
+    assert not hit(redis_instance, "ip:1.1.1.1", RateTier.UNAUTHENTICATED)[0]
+    assert hit(redis_instance, "ip:2.2.2.2", RateTier.UNAUTHENTICATED)[0]
+
+
+def test_each_request_takes_exactly_one_token(clock, redis_instance):
+    hit(redis_instance, "key:a", RateTier.ELEVATED)
+    tokens = asyncio.run(redis_instance.hget("bucket:key:a", "tokens"))
+    assert float(tokens) == RateLimits.TIER_LIMITS[RateTier.ELEVATED] - 1
+
+
+@pytest.mark.parametrize("tier, per_second", [(RateTier.USER, 1), (RateTier.ELEVATED, 4)])
+def test_steady_traffic_under_limit_keeps_full_burst(clock, redis_instance, tier, per_second):
+    # Two minutes below the limit must not eat into the capacity for a later burst
+    for _ in range(120 * per_second):
+        assert hit(redis_instance, "key:a", tier)[0]
+        clock.advance(1 / per_second)
+
+    burst = RateLimits.TIER_LIMITS[tier] // 10
+    denied = sum(not hit(redis_instance, "key:a", tier)[0] for _ in range(burst))
+    assert denied == 0
+
+
+def test_known_denial_is_served_without_redis(clock, redis_instance, monkeypatch):
+    limit = RateLimits.TIER_LIMITS[RateTier.UNAUTHENTICATED]
+    for _ in range(limit + 1):
+        hit(redis_instance, "ip:1.1.1.1", RateTier.UNAUTHENTICATED)
+
+    async def fail(*args, **kwargs):
+        raise AssertionError("Redis should not be called while the denial is cached")
+
+    monkeypatch.setattr(redis_instance, "evalsha", fail)
+    allowed, retry_after_ms = hit(redis_instance, "ip:1.1.1.1", RateTier.UNAUTHENTICATED)
+    assert not allowed
+    assert retry_after_ms > 0
+
+
+def test_bucket_key_expires_once_full_again(clock, redis_instance):
+    hit(redis_instance, "key:a", RateTier.USER)
+    pttl = asyncio.run(redis_instance.pttl("bucket:key:a"))
+    # One token spent, so the bucket is full again after one refill interval
+    assert 0 < pttl <= 60000 // RateLimits.TIER_LIMITS[RateTier.USER] + 1
+
+
+def make_request(headers, client_host="10.0.0.1"):
+    from starlette.requests import Request
+
+    return Request({
+        "type": "http",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        "client": (client_host, 1234),
+    })
+
+
+def test_client_identifier_uses_proxy_appended_forwarded_entry():
+    request = make_request({"X-Forwarded-For": "6.6.6.6, 7.7.7.7,  203.0.113.5 "})
+    assert rate_limit.get_client_identifier(request) == "203.0.113.5"
+
+
+def test_client_identifier_falls_back_to_peer_address():
+    assert rate_limit.get_client_identifier(make_request({})) == "10.0.0.1"
+    assert rate_limit.get_client_identifier(make_request({"X-Forwarded-For": " "})) == "10.0.0.1"